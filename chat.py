@@ -0,0 +1,416 @@
+import gzip
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class JoinRateLimiter:
+    """
+        Sliding window limiter for IRC JOINs
+
+        Twitch counts every channel in a JOIN against the limit, so a batched
+        `JOIN #a,#b,#c` costs three joins.
+    """
+
+    def __init__(self, joins_per_window=20, window=10):
+        self.__joins_per_window = joins_per_window
+        self.__window = window
+        self.__history = deque()
+        self.__lock = threading.Lock()
+
+    def __expire(self, now):
+        while self.__history and now - self.__history[0] >= self.__window:
+            self.__history.popleft()
+
+    def acquire(self, wanted):
+        """
+            Reserve up to `wanted` joins and return how many were granted
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            granted = min(wanted, self.__joins_per_window - len(self.__history))
+            for _ in range(granted):
+                self.__history.append(now)
+            return granted
+
+    def time_until_available(self):
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            if len(self.__history) < self.__joins_per_window:
+                return 0
+            return self.__window - (now - self.__history[0])
+
+
+class ChatLog:
+    """
+        Append-only gzip chat log for a single recording
+
+        Lines are buffered for `flush_interval` seconds and then appended as
+        a complete gzip member. If the process dies, the log still reads
+        cleanly up to the last flush.
+    """
+
+    def __init__(self, path, flush_interval=5):
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__lines = []
+        self.__closed = False
+        self.__last_flush = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def write(self, timestamp, username, message):
+        msec = int((timestamp % 1) * 1000)
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+        line = f"[{stamp}.{msec:03d}] <{username}> {message}\n"
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__lines.append(line.encode("utf-8"))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.monotonic() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            if not self.__closed and self.__lines:
+                self.__append()
+            self.__last_flush = time.monotonic()
+
+    def __append(self):
+        with gzip.open(self.__path, "ab") as f:
+            f.write(b"".join(self.__lines))
+        self.__lines = []
+
+    def close(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            # always written so a recording without chat still gets a valid log
+            self.__append()
+            self.__closed = True
+
+    def get_path(self):
+        return self.__path
+
+
+class ChatConnection:
+    """
+        One IRC connection shared by several channels
+
+        Anonymous (justinfan) login is used since the logs are read only.
+        The connection reconnects on its own. Once the server has accepted
+        the login it asks the pool to join its channels so the joins go
+        through the shared rate limiter.
+    """
+
+    def __init__(self, host, port, on_message, on_reconnect, timeout=1):
+        self.__host = host
+        self.__port = port
+        self.__on_message = on_message
+        self.__on_reconnect = on_reconnect
+        self.__timeout = timeout
+        self.__socket = None
+        self.__registered = False
+        self.__send_lock = threading.Lock()
+        self.__channels = set()
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        # connecting happens on the reader thread so a slow or unreachable
+        # server never blocks the recording loop
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__read_loop, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        self.__close_socket()
+        self.__thread = None
+
+    def __connect(self):
+        self.__socket = socket.create_connection((self.__host, self.__port), timeout=10)
+        self.__socket.settimeout(self.__timeout)
+        self.send("PASS SCHMOOPIIE")
+        self.send(f"NICK justinfan{random.randint(10000, 99999)}")
+        logger.debug(f"connected to chat {self.__host}:{self.__port}")
+
+    def __close_socket(self):
+        self.__registered = False
+        if self.__socket is not None:
+            try:
+                self.__socket.close()
+            except OSError:
+                pass
+            self.__socket = None
+
+    def send(self, line):
+        with self.__send_lock:
+            if self.__socket is None:
+                raise OSError("chat connection is closed")
+            self.__socket.sendall(f"{line}\r\n".encode("utf-8"))
+
+    def join(self, channels):
+        self.send("JOIN " + ",".join(f"#{channel}" for channel in channels))
+
+    def part(self, channels):
+        self.send("PART " + ",".join(f"#{channel}" for channel in channels))
+
+    def __reconnect(self):
+        self.__close_socket()
+        delay = 1
+        while self.__running:
+            try:
+                self.__connect()
+                break
+            except OSError:
+                logger.error(
+                    f"couldn't reconnect to chat. trying again in {delay} seconds",
+                    exc_info=True,
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def __read_loop(self):
+        buffer = b""
+        self.__reconnect()
+        while self.__running:
+            try:
+                data = self.__socket.recv(4096)
+            except socket.timeout:
+                continue
+            except (OSError, AttributeError):
+                if not self.__running:
+                    break
+                logger.warning("chat connection lost. reconnecting")
+                buffer = b""
+                self.__reconnect()
+                continue
+            if not data:
+                if not self.__running:
+                    break
+                logger.warning("chat connection closed by server. reconnecting")
+                buffer = b""
+                self.__reconnect()
+                continue
+            buffer += data
+            *lines, buffer = buffer.split(b"\r\n")
+            for line in lines:
+                self.__handle_line(line.decode("utf-8", errors="replace"))
+
+    def __handle_line(self, line):
+        if line.startswith("PING"):
+            try:
+                self.send("PONG" + line[4:])
+            except OSError:
+                pass
+            return
+        if line.startswith("@"):
+            # drop IRCv3 tags if the server sends them anyway
+            line = line.split(" ", 1)[1]
+        if not line.startswith(":"):
+            return
+        parts = line.split(" ", 3)
+        if len(parts) > 1 and parts[1] == "001":
+            # welcome message, the server only takes JOINs after this
+            self.__registered = True
+            self.__on_reconnect(self)
+            return
+        if len(parts) < 4 or parts[1] != "PRIVMSG":
+            return
+        username = parts[0][1:].split("!", 1)[0]
+        channel = parts[2].lstrip("#")
+        message = parts[3][1:] if parts[3].startswith(":") else parts[3]
+        self.__on_message(channel, username, message)
+
+    def get_channels(self):
+        return self.__channels
+
+    def is_registered(self):
+        return self.__registered
+
+
+class ChatRecorder:
+    """
+        Captures chat for every channel that is being recorded
+
+        Channels are spread over a small pool of shared IRC connections.
+        Joins are queued and sent in batches no faster than the rate limiter
+        allows. Each recording gets its own log named after the `.ts` file so
+        splits from `max_file_size` start a new chat log as well.
+    """
+
+    def __init__(
+        self,
+        capture_path,
+        complete_path,
+        host="irc.chat.twitch.tv",
+        port=6667,
+        channels_per_connection=50,
+        joins_per_window=20,
+        join_window=10,
+        flush_interval=5,
+    ):
+        self.__capture_path = capture_path
+        self.__complete_path = complete_path
+        self.__host = host
+        self.__port = port
+        self.__channels_per_connection = channels_per_connection
+        self.__flush_interval = flush_interval
+        self.__rate_limiter = JoinRateLimiter(joins_per_window, join_window)
+        self.__connections = []
+        self.__channel_connection = dict()
+        self.__logs = dict()
+        self.__pending_joins = deque()
+        self.__lock = threading.RLock()
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__join_loop, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.__lock:
+            for channel in list(self.__logs.keys()):
+                self.stop_log(channel)
+            for connection in self.__connections:
+                connection.stop()
+            self.__connections = []
+
+    def start_log(self, channel, filename):
+        """
+            Start a new chat log for `channel` matching the recording `filename`
+
+            Any log already open for the channel is closed and moved first,
+            which is what happens when a recording is split.
+        """
+        with self.__lock:
+            if channel in self.__logs:
+                self.__close_log(channel)
+            path = os.path.join(self.__capture_path, self.get_log_filename(filename))
+            self.__logs[channel] = ChatLog(path, self.__flush_interval)
+            if channel not in self.__channel_connection:
+                connection = self.__assign_connection(channel)
+                # otherwise the connection queues it once it has logged in
+                if connection.is_registered():
+                    self.__pending_joins.append(channel)
+        logger.debug(f"Started chat log for {channel} - {path}")
+
+    def stop_log(self, channel):
+        """
+            Close and move the chat log for `channel` and leave the channel
+        """
+        with self.__lock:
+            if channel in self.__logs:
+                self.__close_log(channel)
+            connection = self.__channel_connection.pop(channel, None)
+            try:
+                self.__pending_joins.remove(channel)
+            except ValueError:
+                pass
+            if connection is None:
+                return
+            connection.get_channels().discard(channel)
+            if connection.is_registered():
+                try:
+                    connection.part([channel])
+                except OSError:
+                    pass
+            if len(connection.get_channels()) == 0:
+                connection.stop()
+                self.__connections.remove(connection)
+
+    def __close_log(self, channel):
+        log = self.__logs.pop(channel)
+        log.close()
+        path = log.get_path()
+        try:
+            os.rename(
+                path, os.path.join(self.__complete_path, os.path.basename(path))
+            )
+        except FileNotFoundError:
+            logger.error(f"{path} not found. probably deleted by user")
+        logger.debug(f"Stopped chat log for {channel} - {path}")
+
+    def __assign_connection(self, channel):
+        # fill the least used connection before opening a new one
+        connection = None
+        for candidate in self.__connections:
+            if len(candidate.get_channels()) < self.__channels_per_connection and (
+                connection is None
+                or len(candidate.get_channels()) < len(connection.get_channels())
+            ):
+                connection = candidate
+        if connection is None:
+            connection = ChatConnection(
+                self.__host, self.__port, self.__on_message, self.__on_reconnect
+            )
+            connection.start()
+            self.__connections.append(connection)
+        connection.get_channels().add(channel)
+        self.__channel_connection[channel] = connection
+        return connection
+
+    def __on_message(self, channel, username, message):
+        log = self.__logs.get(channel)
+        if log is not None:
+            log.write(time.time(), username, message)
+
+    def __on_reconnect(self, connection):
+        with self.__lock:
+            for channel in connection.get_channels():
+                if channel not in self.__pending_joins:
+                    self.__pending_joins.append(channel)
+
+    def __join_loop(self):
+        while self.__running:
+            self.__send_pending_joins()
+            for log in list(self.__logs.values()):
+                log.flush_if_due()
+            time.sleep(max(min(self.__rate_limiter.time_until_available(), 1), 0.1))
+
+    def __send_pending_joins(self):
+        with self.__lock:
+            # channels on a connection that isn't logged in yet are queued
+            # again when it is, so don't spend join budget on them now
+            self.__pending_joins = deque(
+                channel
+                for channel in self.__pending_joins
+                if channel in self.__channel_connection
+                and self.__channel_connection[channel].is_registered()
+            )
+            if len(self.__pending_joins) == 0:
+                return
+            granted = self.__rate_limiter.acquire(len(self.__pending_joins))
+            batches = dict()
+            for _ in range(granted):
+                channel = self.__pending_joins.popleft()
+                connection = self.__channel_connection.get(channel)
+                if connection is not None:
+                    batches.setdefault(connection, []).append(channel)
+            for connection, channels in batches.items():
+                try:
+                    connection.join(channels)
+                    logger.debug(f"joined chat for {channels}")
+                except OSError:
+                    # the connection will queue its channels again once it reconnects
+                    logger.warning(f"chat connection lost while joining {channels}")
+
+    def get_log_filename(self, filename):
+        return f"{os.path.splitext(filename)[0]}.log.gz"
@@ -12,6 +12,10 @@ from timeit import default_timer as timer
 from streamer import Streamer
 from api import API as twitch
 from discord_bot import Bot
+from chat import ChatRecorder
+from rules import RulesEngine
+import tiering
+from session_trace import TraceWriter
 
 logger = logging.getLogger(__name__)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -19,9 +23,34 @@ logging.getLogger("discord").setLevel(logging.ERROR)
 
 
 class Record:
-    def __init__(self):
+    def __init__(
+        self,
+        config_path=None,
+        clock=time,
+        helix=None,
+        process_factory=subprocess.Popen,
+        trace=None,
+    ):
+        """
+            Parameters
+            ----------
+            config_path : str
+                defaults to config.ini next to this file
+            clock : module or object
+                the time module, or a SimulatedClock when replaying a trace
+            helix : API
+                defaults to the Twitch API with the credentials from the config
+            process_factory : callable
+                starts the recording process, subprocess.Popen by default
+            trace : TraceWriter or MemoryTrace
+                where to write trace events, defaults to the [trace] config
+        """
         self.__current_directory = os.path.dirname(os.path.realpath(__file__))
-        self.__config_path = os.path.join(self.__current_directory, "config.ini")
+        self.__config_path = config_path or os.path.join(
+            self.__current_directory, "config.ini"
+        )
+        self.__clock = clock
+        self.__process_factory = process_factory
 
         fileH = logging.handlers.TimedRotatingFileHandler("logs/log", when="midnight")
         fileH.suffix = "_%Y-%m-%d_%H-%M-%S.log"
@@ -42,6 +71,10 @@ class Record:
             self.__config["default"]["complete_directory"]
         )
 
+        self.__index_segments = self.__config.getboolean(
+            "default", "segment_index", fallback=False
+        )
+
         self.__discord_webhook = self.__config["discord"]["webhook"]
         self.__verbosity = self.__config.getint("default", "verbosity")
         self.__restrict_games = self.__config.getboolean(
@@ -51,7 +84,7 @@ class Record:
 
         self.__client_id = self.__config["twitchapi"]["client_id"]
         self.__client_secret = self.__config["twitchapi"]["client_secret"]
-        self.__helix = twitch(
+        self.__helix = helix or twitch(
             self.__client_id,
             self.__client_secret,
             self.__config["twitchapi"]["bearer_token"],
@@ -65,47 +98,107 @@ class Record:
         )
         self.__paused_streamers = json.loads(self.__config["streamers"]["paused"])
 
+        self.__rules = None
+        self.__rules_key = None
+        self.__rules_list = []
+        self.__cut_on_category_change = False
+        self.__category_changes = dict()
+        self.__compile_rules(
+            self.__games, json.loads(self.__config.get("rules", "rules", fallback="[]"))
+        )
+
         self.__streamers = dict()
         self.__streamer_ids = dict()
         self.__online = []
         self.__offline = []
         self.__recording = []
 
+        self.__trace = trace
+        if self.__trace is None and self.__config.getboolean(
+            "trace", "enable", fallback=False
+        ):
+            trace_directory = self.__config.get("trace", "directory", fallback="traces")
+            os.makedirs(trace_directory, exist_ok=True)
+            self.__trace = TraceWriter(
+                os.path.join(
+                    trace_directory, f"trace_{time.strftime('%Y-%m-%d_%H-%M-%S')}.jsonl.gz"
+                )
+            )
+
         self.__create_streamers()
 
-        self.__bot_enable = self.__config["discord"]["bot_enable"]
+        self.__chat = None
+        if self.__config.getboolean("chat", "enable", fallback=False):
+            self.__chat = ChatRecorder(
+                self.__capture_directory,
+                self.__complete_directory,
+                host=self.__config.get("chat", "host", fallback="irc.chat.twitch.tv"),
+                port=self.__config.getint("chat", "port", fallback=6667),
+                channels_per_connection=self.__config.getint(
+                    "chat", "channels_per_connection", fallback=50
+                ),
+                joins_per_window=self.__config.getint(
+                    "chat", "joins_per_window", fallback=20
+                ),
+                join_window=self.__config.getfloat("chat", "join_window", fallback=10),
+                flush_interval=self.__config.getfloat(
+                    "chat", "flush_interval", fallback=5
+                ),
+            )
+            self.__chat.start()
+
+        self.__tiering = tiering.from_config(
+            self.__config,
+            self.__complete_directory,
+            os.path.join(self.__current_directory, "tiering.db"),
+        )
+        if self.__tiering is not None:
+            self.__tiering.start()
+
+        self.__bot = None
+        self.__bot_enable = self.__config.getboolean(
+            "discord", "bot_enable", fallback=False
+        )
         if self.__bot_enable:
             self.__bot_token = self.__config["discord"]["bot_token"]
             self.__bot_channel_id = self.__config["discord"]["bot_channel_id"]
             self.__status_msg_id = self.__config["discord"]["status_msg_id"]
-        self.__bot = Bot(
-            bot_token=self.__bot_token,
-            channel_id=self.__bot_channel_id,
-            msg_id=self.__status_msg_id,
-            embed_template={
-                "title": "Status",
-                "description": "**Recording**: {recording}\n\n**Online**: {online}\n\n**Offline**: {offline}\n\n**Paused**: {paused}",
-                "color": 7506394,
-            },
-        )
+            self.__bot = Bot(
+                bot_token=self.__bot_token,
+                channel_id=self.__bot_channel_id,
+                msg_id=self.__status_msg_id,
+                embed_template={
+                    "title": "Status",
+                    "description": "**Recording**: {recording}\n\n**Online**: {online}\n\n**Offline**: {offline}\n\n**Paused**: {paused}",
+                    "color": 7506394,
+                },
+            )
 
     def __create_streamers(self):
         streamers = self.__load_streamers()
         streamer_ids = self.__get_streamers_id(streamers)
         for streamer in streamers:
             streamer_name = streamer.lower()
-            self.__streamers[streamer_name] = Streamer(
-                streamer_name,
-                self.__capture_directory,
-                streamer_ids.get(streamer_name),
-                self.__complete_directory,
+            self.__streamers[streamer_name] = self.__new_streamer(
+                streamer_name, streamer_ids.get(streamer_name)
             )
 
+    def __new_streamer(self, streamer_name, streamer_id):
+        return Streamer(
+            streamer_name,
+            self.__capture_directory,
+            streamer_id,
+            self.__complete_directory,
+            self.__index_segments,
+            self.__clock,
+            self.__process_factory,
+        )
+
     def __load_streamers(self):
         return json.loads(self.__config["streamers"]["streamers"])
 
     def __get_streamers_id(self, streamers):
-        if time.time() > self.__bearer_token_expiration:
+        if self.__clock.time() > self.__bearer_token_expiration:
             self.__update_bearer_token()
 
         params = {"login": streamers}
@@ -120,17 +213,24 @@ class Record:
                     "Twitch is probably having issues. Trying again in 1 minute.",
                     exc_info=True,
                 )
-                time.sleep(60)
+                self.__clock.sleep(60)
                 pass
 
         streamers_with_id = dict()
         for streamer in response.get("data"):
             streamers_with_id[streamer["login"]] = streamer["id"]
             self.__streamer_ids[streamer["id"]] = streamer["login"]
+        self.__trace_event("users", users=streamers_with_id)
         return streamers_with_id
 
+    def __trace_event(self, event_type, **fields):
+        if self.__trace is not None:
+            self.__trace.event(event_type, self.__clock.time(), **fields)
+
     def __update_discord(self):
         self.__paused_streamers.sort()
+        if self.__bot is None:
+            return
         self.__status_msg_id = self.__bot.update_discord(
             recording=self.__bot.format_discord_list(self.__recording),
             online=self.__bot.format_discord_list(self.__online),
@@ -152,6 +252,10 @@ class Record:
                 1024 * 1024 * 1024 * self.__config.getfloat("default", "max_file_size")
             )
             self.__paused_streamers = json.loads(self.__config["streamers"]["paused"])
+            self.__games = json.loads(self.__config["twitch_categories"]["games"])
+            self.__cut_on_category_change = self.__config.getboolean(
+                "rules", "cut_on_category_change", fallback=False
+            )
             streamers = json.loads(self.__config["streamers"]["streamers"])
             forced_streamers = json.loads(
                 self.__config["streamers"]["forced_streamers"]
@@ -165,6 +269,13 @@ class Record:
                 "Error updating streamers. Make sure to encase streamer name in quotations."
             )
             return None
+        try:
+            rules = json.loads(self.__config.get("rules", "rules", fallback="[]"))
+        except json.decoder.JSONDecodeError as e:
+            # a typo in the rules shouldn't hold up the streamer changes
+            print(f"Error reading recording rules, keeping the previous rules. {e}")
+            logger.error("error parsing recording rules", exc_info=True)
+            rules = self.__rules_list
         if len(include) > 0:
             # add to self.__streamers
             streamer_ids = self.__get_streamers_id(include)
@@ -172,11 +283,8 @@ class Record:
                 streamer_name = streamer.lower()
                 if streamer_name not in self.__streamers:
                     streamers.append(streamer_name)
-                    self.__streamers[streamer_name] = Streamer(
-                        streamer_name,
-                        self.__capture_directory,
-                        streamer_ids.get(streamer_name),
-                        self.__complete_directory,
+                    self.__streamers[streamer_name] = self.__new_streamer(
+                        streamer_name, streamer_ids.get(streamer_name)
                     )
         if len(exclude) > 0:
             # Remove from self.__streamers, streamers, and forced_streamers
@@ -186,7 +294,7 @@ class Record:
                     try:
                         temp_streamer = self.__streamers.get(streamer_name)
                         if temp_streamer.get_recording_status() == True:
-                            temp_streamer.stop_recording()
+                            self.__stop_recording(temp_streamer, "exclude")
                         del self.__streamers[streamer_name]
                         streamers.remove(streamer_name)
                         forced_streamers.remove(streamer_name)
@@ -203,11 +311,8 @@ class Record:
                     self.__forced_streamers.append(streamer_name)
                 if streamer_name not in streamers:
                     streamers.append(streamer_name)
-                    self.__streamers[streamer_name] = Streamer(
-                        streamer_name,
-                        self.__capture_directory,
-                        streamer_ids.get(streamer_name),
-                        self.__complete_directory,
+                    self.__streamers[streamer_name] = self.__new_streamer(
+                        streamer_name, streamer_ids.get(streamer_name)
                     )
         if len(force_exclude) > 0:
             # remove from self.__forced_streamers
@@ -225,6 +330,39 @@ class Record:
         self.__config["streamers"]["force_include"] = json.dumps([])
         self.__config["streamers"]["force_exclude"] = json.dumps([])
         self.__update_config()
+        self.__compile_rules(self.__games, rules)
+
+    def __compile_rules(self, games, rules):
+        # only recompile when something the rules depend on has changed
+        key = json.dumps(
+            [
+                self.__restrict_games,
+                games,
+                self.__forced_streamers,
+                self.__paused_streamers,
+                rules,
+            ]
+        )
+        if key == self.__rules_key:
+            return
+        try:
+            self.__rules = RulesEngine.from_config(
+                self.__restrict_games,
+                games,
+                self.__forced_streamers,
+                self.__paused_streamers,
+                rules,
+            )
+        except (ValueError, TypeError) as e:
+            if self.__rules is None:
+                # nothing to fall back on when starting up
+                raise
+            print(f"Error in recording rules, keeping the previous rules. {e}")
+            logger.error("error compiling recording rules", exc_info=True)
+            return
+        self.__rules_key = key
+        self.__rules_list = rules
+        logger.debug("compiled recording rules")
 
     def __update_config(self):
         with open(self.__config_path, "w") as f:
@@ -250,35 +388,62 @@ class Record:
             response = self.__helix.request(
                 "GET", "https://api.twitch.tv/helix/streams", params=params
             )
-        except requests.exceptions.HTTPError:
+        except requests.exceptions.HTTPError as e:
             logger.error("Twitch is probably having issues.", exc_info=True)
+            self.__trace_event("error", error=str(e))
             return
         if response is None:
             return
-        if time.time() > self.__bearer_token_expiration:
+        self.__trace_event(
+            "streams",
+            data=[
+                {
+                    "user_id": stream.get("user_id"),
+                    "game_id": stream.get("game_id"),
+                    "title": stream.get("title"),
+                    "started_at": stream.get("started_at"),
+                }
+                for stream in response.get("data", [])
+            ],
+        )
+        if self.__clock.time() > self.__bearer_token_expiration:
             # write new bearer token to config
             self.__update_bearer_token()
 
         try:
-            # Go through streamers that are live
-            for streamer in response.get("data"):
-                # get username from id
-                # twitch returns local name so it may return foreign characters
-                username = self.__streamer_ids[streamer["user_id"]]
-                if username not in self.__paused_streamers and (
-                    self.__restrict_games is False
-                    or streamer.get("game_id") in self.__games
-                    or username in self.__forced_streamers
-                ):
-                    self.__streamers[username].set_live_status(True)
-                    streamers.remove(username)
-            # set remaining streamers to offline
+            # Decide every live stream at once. Streamers that aren't live or
+            # that the rules don't want recorded are set to offline.
+            # twitch returns local name so it may return foreign characters,
+            # the rules engine maps user ids back to usernames
+            decisions = self.__rules.evaluate(
+                response.get("data"), self.__streamer_ids, self.__clock.localtime()
+            )
+            self.__trace_event(
+                "decisions",
+                record=[name for name, (wanted, _) in decisions.items() if wanted],
+                skip=[name for name, (wanted, _) in decisions.items() if not wanted],
+            )
             for username in streamers:
-                self.__streamers[username].set_live_status(False)
+                streamer = self.__streamers[username]
+                live = username in decisions
+                should_record, game_id = decisions.get(username, (False, None))
+                previous_game_id = streamer.get_game_id()
+                streamer.set_game_id(game_id)
+                if live and streamer.get_recording_status() == True:
+                    if should_record is False:
+                        # category, title or time window no longer matches
+                        self.__category_changes[username] = "stop"
+                    elif (
+                        self.__cut_on_category_change
+                        and previous_game_id is not None
+                        and game_id != previous_game_id
+                    ):
+                        self.__category_changes[username] = "cut"
+                streamer.set_live_status(should_record)
         except KeyError as e:
             print(f"keyerror {response}")
             print(e.args[0])
-            time.sleep(30)
+            self.__clock.sleep(30)
 
     def __handle_recording(self, streamer):
         # Chooses what to do based on a streamer's statuses
@@ -290,19 +455,44 @@ class Record:
         current_time = self.__get_current_time()
         streamer_name = streamer.get_name()
 
+        filename = streamer.get_filename()
         streamer.check_recording_process()
+        if filename != streamer.get_filename():
+            # recording process exited on its own
+            self.__trace_event("process_exit", channel=streamer_name, filename=filename)
+            if self.__chat is not None:
+                self.__chat.stop_log(streamer_name)
 
         live_status = streamer.get_live_status()
         recording_status = streamer.get_recording_status()
+        category_change = self.__category_changes.pop(streamer_name, None)
 
         # logger.debug(
         #     f"{streamer_name:16} - live: {str(live_status):5} - recording: {str(recording_status)}"
         # )
 
         if live_status == True and recording_status == False:
-            streamer.start_recording()
+            self.__start_recording(streamer)
             self.__recording.append(streamer_name)
             return 1
+        elif category_change == "stop" and recording_status == True:
+            # streamer is still live but the rules don't want this anymore,
+            # no need to wait for the file size check used for going offline
+            logger.debug(
+                f"{streamer_name} changed to category {streamer.get_game_id()} that isn't recorded. stopping recording."
+            )
+            self.__stop_recording(streamer, "rules")
+            try:
+                self.__recording.remove(streamer_name)
+            except ValueError:
+                logger.error(f"{streamer_name} not in recording list")
+            return -1
+        elif category_change == "cut" and recording_status == True:
+            print(
+                f"\n----------[{current_time}] {streamer_name} changed category. Restarting recording----------\n"
+            )
+            self.__split_recording(streamer, "cut")
+            return 2
         elif (
             live_status == False
             and recording_status == True
@@ -313,7 +503,7 @@ class Record:
             logger.debug(
                 f"{streamer_name} has gone offline. stopping recording. these streamers are still recording {self.__recording}"
             )
-            streamer.stop_recording()
+            self.__stop_recording(streamer, "offline")
             try:
                 self.__recording.remove(streamer_name)
             except ValueError:
@@ -327,17 +517,52 @@ class Record:
             print(
                 f"\n----------[{current_time}] {streamer_name} file size exceeded. Restarting recording----------\n"
             )
-            streamer.stop_recording()
-            streamer.start_recording()
+            self.__split_recording(streamer, "split")
             return 2
         return 0
 
+    def __start_recording(self, streamer):
+        streamer.start_recording()
+        self.__trace_event(
+            "process_start",
+            channel=streamer.get_name(),
+            filename=streamer.get_filename(),
+        )
+        if self.__chat is not None:
+            # starting a new log also rotates the previous one after a split
+            self.__chat.start_log(streamer.get_name(), streamer.get_filename())
+
+    def __stop_recording(self, streamer, reason):
+        self.__trace_event(
+            "process_stop",
+            channel=streamer.get_name(),
+            filename=streamer.get_filename(),
+            reason=reason,
+        )
+        if self.__chat is not None:
+            self.__chat.stop_log(streamer.get_name())
+        streamer.stop_recording()
+
+    def __split_recording(self, streamer, reason):
+        # stop and start a new file without leaving chat
+        self.__trace_event(
+            "process_stop",
+            channel=streamer.get_name(),
+            filename=streamer.get_filename(),
+            reason=reason,
+        )
+        streamer.stop_recording()
+        self.__start_recording(streamer)
+
     def __check_file_size(self, streamer, target_file_size):
         try:
             file_size = os.stat(
                 os.path.join(self.__capture_directory, streamer.get_filename())
             ).st_size
             logger.debug(f"{streamer.get_filename()} is {file_size/(1024*1024)}MB")
+            self.__trace_event(
+                "file_size", filename=streamer.get_filename(), size=file_size
+            )
             if file_size > target_file_size:
                 return True
         except FileNotFoundError:
@@ -358,18 +583,9 @@ class Record:
 
     def __get_changes(self, new, old):
         # Finds changes in lists to determine who went online/offline or started/stopped recording.
-        started = []
-        stopped = []
-        # streamers who went offline or stopped recording
-        if len(new) < len(old):
-            stopped = self.__find_differences_in_lists(old, new)
-        # streamers who went online or started recording
-        elif len(new) > len(old):
-            started = self.__find_differences_in_lists(new, old)
-        # unlikely situtation. same amount of streamers go online and offline at the same time
-        elif len(new) == len(old):
-            stopped = self.__find_differences_in_lists(old, new)
-            started = self.__find_differences_in_lists(new, old)
+        # streamers can go online and offline in the same check, so always look both ways
+        stopped = self.__find_differences_in_lists(old, new)
+        started = self.__find_differences_in_lists(new, old)
 
         return started, stopped
 
@@ -390,6 +606,13 @@ class Record:
             and len(stopped_recording) == 0
         ):
             return
+        self.__trace_event(
+            "status",
+            went_online=went_online,
+            went_offline=went_offline,
+            started_recording=started_recording,
+            stopped_recording=stopped_recording,
+        )
         self.__print_status_changes(
             went_online, went_offline, started_recording, stopped_recording
         )
@@ -449,15 +672,21 @@ class Record:
             except requests.exceptions.ConnectionError:
                 logger.error("requests.exception.ConnectionError", exc_info=True)
                 pass
-            time.sleep(5)
+            self.__clock.sleep(5)
 
     def cleanup(self):
         for key, streamer in self.__streamers.items():
             if streamer.get_recording_status() == True:
-                streamer.stop_recording()
+                self.__stop_recording(streamer, "cleanup")
+        if self.__chat is not None:
+            self.__chat.stop()
+        if self.__tiering is not None:
+            self.__tiering.stop()
+        if self.__trace is not None:
+            self.__trace.close()
 
     def __get_current_time(self):
-        return time.strftime("%H:%M:%S")
+        return self.__clock.strftime("%H:%M:%S")
 
     def get_discord_Webhook(self):
         return self.__discord_webhook
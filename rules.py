@@ -0,0 +1,206 @@
+import heapq
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+RECORD = "record"
+SKIP = "skip"
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+class Rule:
+    """
+        A single recording rule
+
+        Every predicate that is set has to match. `channels` and `games` are
+        sets so membership is a hash lookup, `title` is a compiled regex and
+        `hours`/`days` are checked against local time.
+
+        Parameters
+        ----------
+        action : str
+            "record" or "skip"
+        channels : list
+            lowercase channel logins
+        games : list
+            twitch category ids
+        title : str
+            case-insensitive regex searched for in the stream title
+        hours : str
+            local time window like "18:00-02:00", can wrap past midnight
+        days : list
+            days of the week the rule applies on ("mon" ... "sun")
+    """
+
+    def __init__(
+        self, action, channels=None, games=None, title=None, hours=None, days=None
+    ):
+        if action not in (RECORD, SKIP):
+            raise ValueError(f'rule action must be "{RECORD}" or "{SKIP}", not {action}')
+        self.action = action
+        self.channels = (
+            frozenset(channel.lower() for channel in channels)
+            if channels is not None
+            else None
+        )
+        self.games = frozenset(games) if games is not None else None
+        self.title = re.compile(title, re.IGNORECASE) if title else None
+        self.hours = self.__parse_hours(hours) if hours else None
+        self.days = self.__parse_days(days) if days else None
+
+    @classmethod
+    def from_dict(cls, rule):
+        if not isinstance(rule, dict):
+            raise ValueError(f"rules must be objects, not {rule!r}")
+        unknown = set(rule) - {"action", "channels", "games", "title", "hours", "days"}
+        if unknown:
+            raise ValueError(f"unknown rule keys {sorted(unknown)}")
+        if "action" not in rule:
+            raise ValueError(f"rule {rule} is missing an action")
+        # a string where a list belongs would otherwise be split into letters
+        for key in ("channels", "games", "days"):
+            value = rule.get(key)
+            if value is not None and not (
+                isinstance(value, list) and all(isinstance(item, str) for item in value)
+            ):
+                raise ValueError(f'"{key}" must be a list of strings in rule {rule}')
+        for key in ("action", "title", "hours"):
+            value = rule.get(key)
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f'"{key}" must be a string in rule {rule}')
+        try:
+            return cls(**rule)
+        except re.error as e:
+            raise ValueError(f"bad title pattern in rule {rule}: {e}")
+
+    def __parse_hours(self, hours):
+        try:
+            start, end = hours.split("-")
+            return self.__parse_minute(start), self.__parse_minute(end)
+        except ValueError:
+            raise ValueError(f'hours must look like "18:00-02:00", not {hours}')
+
+    def __parse_minute(self, value):
+        hour, minute = value.strip().split(":")
+        return int(hour) * 60 + int(minute)
+
+    def __parse_days(self, days):
+        try:
+            return frozenset(DAYS.index(day.lower()[:3]) for day in days)
+        except ValueError:
+            raise ValueError(f"days must be some of {DAYS}, not {days}")
+
+    def matches(self, channel, game_id, title, now):
+        if self.channels is not None and channel not in self.channels:
+            return False
+        if self.games is not None and game_id not in self.games:
+            return False
+        if self.title is not None and not self.title.search(title or ""):
+            return False
+        if self.days is not None and now.tm_wday not in self.days:
+            return False
+        if self.hours is not None:
+            minute = now.tm_hour * 60 + now.tm_min
+            start, end = self.hours
+            if start <= end:
+                if not start <= minute < end:
+                    return False
+            elif end <= minute < start:
+                return False
+        return True
+
+
+class RulesEngine:
+    """
+        Decides which live streams get recorded
+
+        Rules are checked in order and the first one that matches wins. To
+        avoid walking every rule for every stream, rules are indexed by
+        channel and by category when compiled, so a stream only looks at the
+        rules that name its channel or its category plus the ones that name
+        neither.
+    """
+
+    def __init__(self, rules, default=True):
+        self.__rules = rules
+        self.__default = default
+        self.__by_channel = dict()
+        self.__by_game = dict()
+        self.__any = []
+        for i, rule in enumerate(rules):
+            if rule.channels is not None:
+                for channel in rule.channels:
+                    self.__by_channel.setdefault(channel, []).append(i)
+            elif rule.games is not None:
+                for game_id in rule.games:
+                    self.__by_game.setdefault(game_id, []).append(i)
+            else:
+                self.__any.append(i)
+
+    @classmethod
+    def from_config(cls, restrict, games, forced, paused, rules=None):
+        """
+            Compile the [streamers] and [twitch_categories] settings plus any
+            extra rules from [rules]
+
+            Order is paused streamers, then the extra rules, then forced
+            streamers, then the category restriction.
+        """
+        if rules is not None and not isinstance(rules, list):
+            raise ValueError(f"rules must be a list, not {rules!r}")
+        compiled = []
+        if paused:
+            compiled.append(Rule(SKIP, channels=paused))
+        for rule in rules or []:
+            compiled.append(Rule.from_dict(rule))
+        if forced:
+            compiled.append(Rule(RECORD, channels=forced))
+        if restrict:
+            compiled.append(Rule(RECORD, games=games))
+        return cls(compiled, default=not restrict)
+
+    def should_record(self, channel, game_id, title, now=None):
+        if now is None:
+            now = time.localtime()
+        candidates = heapq.merge(
+            self.__by_channel.get(channel, ()),
+            self.__by_game.get(game_id, ()),
+            self.__any,
+        )
+        for i in candidates:
+            rule = self.__rules[i]
+            if rule.matches(channel, game_id, title, now):
+                return rule.action == RECORD
+        return self.__default
+
+    def evaluate(self, streams, streamer_ids, now=None):
+        """
+            Decide every stream in a /helix/streams response at once
+
+            Parameters
+            ----------
+            streams : list
+                "data" from the /helix/streams response
+            streamer_ids : dict
+                user id to login, twitch returns display names that can differ
+            now : time.struct_time
+                local time to check time windows against, defaults to now
+
+            Returns
+            -------
+            dict of login to (should record, game id)
+        """
+        if now is None:
+            now = time.localtime()
+        decisions = dict()
+        for stream in streams:
+            username = streamer_ids[stream["user_id"]]
+            game_id = stream.get("game_id")
+            decisions[username] = (
+                self.should_record(username, game_id, stream.get("title"), now),
+                game_id,
+            )
+        return decisions
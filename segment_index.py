@@ -0,0 +1,438 @@
+import argparse
+import bisect
+import logging
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+MAGIC = b"TSIX"
+VERSION = 1
+HEADER = struct.Struct("<4sHd")
+ENTRY = struct.Struct("<QQdB")
+
+KEYFRAME = 1
+DISCONTINUITY = 2
+GAP = 4
+CC_ERROR = 8
+SYNC_LOSS = 16
+
+FLAG_NAMES = {
+    KEYFRAME: "keyframe",
+    DISCONTINUITY: "discontinuity",
+    GAP: "gap",
+    CC_ERROR: "continuity error",
+    SYNC_LOSS: "sync loss",
+}
+
+# stream types from the PMT that carry video
+VIDEO_STREAM_TYPES = {0x01, 0x02, 0x1B, 0x24}
+
+
+def get_index_path(path):
+    return f"{path}.idx"
+
+
+def get_start_time(path):
+    """
+        Wall-clock start of a recording from its `twitch_<name>_<time>.ts` name
+
+        Falls back to the file's modification time if the name doesn't match.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return time.mktime(
+            time.strptime("_".join(stem.split("_")[-2:]), "%Y-%m-%d_%H-%M-%S")
+        )
+    except ValueError:
+        return os.stat(path).st_mtime
+
+
+def _parse_pts(data, start):
+    return (
+        ((data[start] >> 1) & 0x07) << 30
+        | data[start + 1] << 22
+        | (data[start + 2] >> 1) << 15
+        | data[start + 3] << 7
+        | data[start + 4] >> 1
+    )
+
+
+def _section_start(data, payload_start):
+    # skip the pointer field in front of a PSI section
+    return payload_start + 1 + data[payload_start]
+
+
+def _parse_pat(data, offset, payload_start):
+    start = _section_start(data, payload_start)
+    section_length = ((data[start + 1] & 0x0F) << 8) | data[start + 2]
+    end = min(start + 3 + section_length - 4, offset + PACKET_SIZE)
+    for i in range(start + 8, end, 4):
+        program = (data[i] << 8) | data[i + 1]
+        if program != 0:
+            return ((data[i + 2] & 0x1F) << 8) | data[i + 3]
+    return None
+
+
+def _parse_pmt(data, offset, payload_start):
+    start = _section_start(data, payload_start)
+    section_length = ((data[start + 1] & 0x0F) << 8) | data[start + 2]
+    end = min(start + 3 + section_length - 4, offset + PACKET_SIZE)
+    info_length = ((data[start + 10] & 0x0F) << 8) | data[start + 11]
+    i = start + 12 + info_length
+    while i + 5 <= end:
+        stream_type = data[i]
+        pid = ((data[i + 1] & 0x1F) << 8) | data[i + 2]
+        if stream_type in VIDEO_STREAM_TYPES:
+            return pid
+        i += 5 + (((data[i + 3] & 0x0F) << 8) | data[i + 4])
+    return None
+
+
+def _has_idr(data, start, end):
+    # look for an IDR slice or SPS in the first packet of the PES payload
+    i = data.find(b"\x00\x00\x01", start, end)
+    while i != -1 and i + 3 < end:
+        if data[i + 3] & 0x1F in (5, 7):
+            return True
+        i = data.find(b"\x00\x00\x01", i + 3, end)
+    return False
+
+
+def _resync(data, offset, size):
+    while offset + PACKET_SIZE < size:
+        offset = data.find(b"\x47", offset + 1)
+        if offset == -1 or offset + PACKET_SIZE >= size:
+            return size
+        if data[offset + PACKET_SIZE] == SYNC_BYTE:
+            return offset
+    return size
+
+
+def scan(path, gap_threshold=1.0, max_gap=600):
+    """
+        Scan an MPEG-TS file and return its index entries
+
+        Only headers are parsed, the video itself is never decoded. An entry
+        is emitted for every keyframe and for every place the stream is
+        damaged. `time` is seconds of decode time (DTS, or PTS when a frame has
+        no DTS) since the first frame; forward jumps up to `max_gap` seconds
+        count as missing segments and advance `time`, anything else is treated
+        as a timestamp reset. Entries store the frame's PTS.
+
+        Parameters
+        ----------
+        path : str
+            recording to scan
+        gap_threshold : float
+            seconds between frames before it's considered a missing segment
+        max_gap : float
+            largest forward jump in seconds that is still considered a gap
+
+        Returns
+        -------
+        list of (offset, pts, time, flags) tuples
+    """
+    entries = []
+    size = os.path.getsize(path)
+    if size < PACKET_SIZE:
+        return entries
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pmt_pid = None
+        video_pid = None
+        continuity = None
+        last_dts = None
+        elapsed = 0
+        pending = 0
+        offset = 0
+        while offset + PACKET_SIZE <= size:
+            if data[offset] != SYNC_BYTE:
+                offset = _resync(data, offset, size)
+                pending |= SYNC_LOSS
+                continue
+            pid = ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+            if pid != video_pid and pid != 0 and pid != pmt_pid:
+                offset += PACKET_SIZE
+                continue
+
+            unit_start = data[offset + 1] & 0x40
+            adaptation = (data[offset + 3] >> 4) & 0x03
+            payload_start = offset + 4
+            random_access = False
+            if adaptation & 0x02:
+                adaptation_length = data[offset + 4]
+                if adaptation_length > 0:
+                    adaptation_flags = data[offset + 5]
+                    if adaptation_flags & 0x80:
+                        pending |= DISCONTINUITY
+                        continuity = None
+                    random_access = bool(adaptation_flags & 0x40)
+                payload_start += 1 + adaptation_length
+            has_payload = adaptation & 0x01 and payload_start < offset + PACKET_SIZE
+
+            if pid == 0:
+                if unit_start and has_payload:
+                    pmt_pid = _parse_pat(data, offset, payload_start)
+                offset += PACKET_SIZE
+                continue
+            if pid == pmt_pid:
+                if unit_start and has_payload:
+                    video_pid = _parse_pmt(data, offset, payload_start)
+                offset += PACKET_SIZE
+                continue
+
+            # video packet
+            counter = data[offset + 3] & 0x0F
+            if has_payload:
+                if continuity is not None and counter != (continuity + 1) & 0x0F:
+                    if counter != continuity:
+                        pending |= CC_ERROR
+                continuity = counter
+
+            if (
+                unit_start
+                and has_payload
+                and payload_start + 14 <= offset + PACKET_SIZE
+                and data[payload_start : payload_start + 3] == b"\x00\x00\x01"
+                and data[payload_start + 7] & 0x80
+            ):
+                pts = _parse_pts(data, payload_start + 9)
+                # with B-frames PTS jumps back and forth, DTS only moves forward
+                dts = pts
+                if (
+                    data[payload_start + 7] & 0xC0 == 0xC0
+                    and payload_start + 19 <= offset + PACKET_SIZE
+                ):
+                    dts = _parse_pts(data, payload_start + 14)
+                if last_dts is not None:
+                    delta = (dts - last_dts) % PTS_WRAP
+                    if delta > PTS_WRAP // 2 or delta > max_gap * PTS_CLOCK:
+                        pending |= DISCONTINUITY
+                    else:
+                        if delta > gap_threshold * PTS_CLOCK:
+                            pending |= GAP
+                        elapsed += delta
+                last_dts = dts
+
+                flags = pending
+                header_length = data[payload_start + 8]
+                if random_access or _has_idr(
+                    data, payload_start + 9 + header_length, offset + PACKET_SIZE
+                ):
+                    flags |= KEYFRAME
+                if flags:
+                    entries.append((offset, pts, elapsed / PTS_CLOCK, flags))
+                pending = 0
+            offset += PACKET_SIZE
+    return entries
+
+
+def write(path, entries, start_time):
+    index_path = get_index_path(path)
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, start_time))
+        for entry in entries:
+            f.write(ENTRY.pack(*entry))
+    os.replace(temp_path, index_path)
+    return index_path
+
+
+def build(path, gap_threshold=1.0, max_gap=600):
+    """
+        Scan a recording and write its sidecar index next to it
+    """
+    started = time.time()
+    entries = scan(path, gap_threshold, max_gap)
+    index_path = write(path, entries, get_start_time(path))
+    logger.debug(
+        f"indexed {path} - {len(entries)} entries in {time.time() - started:.1f}s"
+    )
+    return index_path
+
+
+def build_in_background(path):
+    """
+        Index a finished recording in a separate process
+
+        Scanning a multi-gigabyte file takes a while so it's kept off the
+        recording loop, the same way streamlink is.
+    """
+    return subprocess.Popen(
+        [sys.executable, os.path.realpath(__file__), "build", path],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+class SegmentIndex:
+    """
+        Reader for a sidecar index
+
+        The index is memory-mapped and binary searched in place so lookups
+        don't depend on how long the recording is.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+        self.__file = open(get_index_path(path), "rb")
+        self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.__start_time = HEADER.unpack_from(self.__data, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{get_index_path(path)} is not a segment index")
+        self.__length = (len(self.__data) - HEADER.size) // ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.__length
+        if not 0 <= i < self.__length:
+            raise IndexError(i)
+        return ENTRY.unpack_from(self.__data, HEADER.size + i * ENTRY.size)
+
+    def close(self):
+        self.__data.close()
+        self.__file.close()
+
+    def get_start_time(self):
+        return self.__start_time
+
+    def get_duration(self):
+        if self.__length == 0:
+            return 0.0
+        return self[-1][2]
+
+    def seek(self, seconds):
+        """
+            Byte offset of the last keyframe at or before `seconds` into the recording
+
+            Returns (offset, time) of the keyframe, or None if there isn't one.
+        """
+        times = _EntryTimes(self)
+        i = bisect.bisect_right(times, seconds) - 1
+        while i >= 0:
+            entry = self[i]
+            if entry[3] & KEYFRAME:
+                return entry[0], entry[2]
+            i -= 1
+        # seeking before the first keyframe starts at the first keyframe
+        for entry in self:
+            if entry[3] & KEYFRAME:
+                return entry[0], entry[2]
+        return None
+
+    def seek_wall_clock(self, timestamp):
+        return self.seek(timestamp - self.__start_time)
+
+    def problems(self):
+        """
+            Entries that mark damage in the recording
+        """
+        return [entry for entry in self if entry[3] & ~KEYFRAME]
+
+
+class _EntryTimes:
+    # lets bisect search entry times without unpacking the whole index
+    def __init__(self, index):
+        self.__index = index
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __getitem__(self, i):
+        return self.__index[i][2]
+
+
+def _format_flags(flags):
+    return ", ".join(name for flag, name in FLAG_NAMES.items() if flags & flag)
+
+
+def _format_seconds(seconds):
+    msec = round(seconds * 1000)
+    return time.strftime("%H:%M:%S", time.gmtime(msec // 1000)) + f".{msec % 1000:03d}"
+
+
+def _parse_time(value, start_time):
+    # absolute "YYYY-MM-DD HH:MM:SS", or a position like "1:02:03" / "3723"
+    try:
+        return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M:%S")) - start_time
+    except ValueError:
+        pass
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def _open_index(path):
+    if not os.path.exists(get_index_path(path)):
+        print(f"no index for {path}. building it now")
+        build(path)
+    return SegmentIndex(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build and query sidecar indexes for recorded .ts files"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="write the index for a recording")
+    build_parser.add_argument("path")
+    build_parser.add_argument("--gap-threshold", type=float, default=1.0)
+    seek_parser = commands.add_parser(
+        "seek", help="byte offset of the keyframe at a time in the recording"
+    )
+    seek_parser.add_argument("path")
+    seek_parser.add_argument(
+        "time", help='"YYYY-MM-DD HH:MM:SS" or a position like 1:02:03'
+    )
+    gaps_parser = commands.add_parser("gaps", help="report gaps and damage")
+    gaps_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        print(build(args.path, args.gap_threshold))
+        return 0
+
+    with _open_index(args.path) as index:
+        if args.command == "seek":
+            result = index.seek(_parse_time(args.time, index.get_start_time()))
+            if result is None:
+                print("no keyframes in index")
+                return 1
+            offset, seconds = result
+            wall_clock = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(index.get_start_time() + seconds)
+            )
+            print(f"{offset}\t{_format_seconds(seconds)}\t{wall_clock}")
+            return 0
+
+        problems = index.problems()
+        for offset, pts, seconds, flags in problems:
+            print(f"{_format_seconds(seconds)}\t{offset}\t{_format_flags(flags)}")
+        print(
+            f"{len(problems)} problems in {_format_seconds(index.get_duration())} of video"
+        )
+        return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,558 @@
+import argparse
+import bisect
+import calendar
+import configparser
+import contextlib
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+# a stream counts as still live this long after it was last seen, about one poll
+POLL_GRACE = 10
+# streamlink gives up this long after starting when there's nothing to record
+FAILED_START_DELAY = 5
+DEFAULT_BITRATE = 6000 * 1000 // 8
+
+
+class TraceWriter:
+    """
+        Writes trace events as gzipped JSON lines
+
+        Events are buffered and appended as a complete gzip member every
+        `flush_interval` seconds. If the recorder is killed, everything up to
+        the last flush can still be read.
+    """
+
+    def __init__(self, path, flush_interval=30):
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__lines = []
+        self.__last_flush = time.monotonic()
+        self.event("header", time.time(), version=VERSION)
+
+    def event(self, event_type, t, **fields):
+        fields["t"] = round(t, 3)
+        fields["e"] = event_type
+        self.__lines.append(json.dumps(fields, separators=(",", ":")) + "\n")
+        if time.monotonic() - self.__last_flush >= self.__flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.__lines:
+            with gzip.open(self.__path, "at", encoding="utf-8") as f:
+                f.write("".join(self.__lines))
+            self.__lines = []
+        self.__last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+
+class MemoryTrace:
+    """
+        Keeps trace events in a list, used to capture what a replay decided
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def event(self, event_type, t, **fields):
+        fields["t"] = t
+        fields["e"] = event_type
+        self.events.append(fields)
+
+    def close(self):
+        pass
+
+
+def read_trace(path):
+    """
+        Read a trace, keeping everything before a truncated end
+
+        A trace from a recorder that was killed mid-write ends in an
+        unfinished gzip member. The events before it are still returned.
+    """
+    events = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # cut off mid-line
+                    break
+                if line.strip():
+                    events.append(json.loads(line))
+    except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError):
+        logger.warning(f"{path} ends early, using the first {len(events)} events")
+    return events
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+class SimulatedClock:
+    """
+        Stand-in for the time module that runs `speed` times faster than real time
+
+        Only what Record and Streamer use is implemented. A speed of 0 doesn't
+        sleep at all. Sleeping past `end` raises ReplayFinished, which is how a
+        replay gets out of Record.start().
+    """
+
+    def __init__(self, start, end, speed=100):
+        self.__now = start
+        self.__end = end
+        self.__speed = speed
+
+    def time(self):
+        return self.__now
+
+    def sleep(self, seconds):
+        if self.__speed:
+            time.sleep(seconds / self.__speed)
+        self.__now += seconds
+        if self.__now > self.__end:
+            # only once, so cleaning up afterwards can still sleep
+            self.__end = float("inf")
+            raise ReplayFinished()
+
+    def strftime(self, format, t=None):
+        return time.strftime(format, t or time.localtime(self.__now))
+
+    def localtime(self, seconds=None):
+        return time.localtime(self.__now if seconds is None else seconds)
+
+
+class ReplayAPI:
+    """
+        Answers Helix requests from a trace instead of Twitch
+
+        /helix/streams returns the last response recorded at or before the
+        current simulated time, so replays polling at a different rate see what
+        production would have seen at that moment.
+    """
+
+    def __init__(self, events, clock):
+        self.__clock = clock
+        self.__ids = dict()
+        self.__times = []
+        self.__responses = []
+        for event in events:
+            if event["e"] == "users":
+                self.__ids.update(event["users"])
+            elif event["e"] in ("streams", "error"):
+                self.__times.append(event["t"])
+                self.__responses.append(event)
+
+    def request(self, method, url, **kwargs):
+        params = kwargs.get("params", dict())
+        if url.endswith("/users"):
+            return {
+                "data": [
+                    {"login": login, "id": self.__ids[login]}
+                    for login in params.get("login", [])
+                    if login in self.__ids
+                ]
+            }
+        i = bisect.bisect_right(self.__times, self.__clock.time()) - 1
+        if i < 0:
+            return {"data": []}
+        response = self.__responses[i]
+        if response["e"] == "error":
+            raise requests.exceptions.HTTPError(response.get("error"))
+        wanted = {self.__ids.get(login) for login in params.get("user_login", [])}
+        return {
+            "data": [stream for stream in response["data"] if stream["user_id"] in wanted]
+        }
+
+    def get_bearer_token(self):
+        return "replay"
+
+    def get_bearer_token_expiration(self):
+        return float("inf")
+
+
+class FakeProcess:
+    """
+        Stands in for streamlink during a replay
+
+        The output file grows at `bitrate` bytes per second as a sparse file,
+        so file size checks and max_file_size splits behave like production
+        without using disk. The process exits when the live session it was
+        started in ends, or shortly after starting if the channel wasn't live.
+    """
+
+    def __init__(self, path, clock, exit_time, bitrate):
+        self.pid = 0
+        self.__path = path
+        self.__clock = clock
+        self.__start = clock.time()
+        self.__exit_time = exit_time
+        self.__bitrate = bitrate
+        self.__returncode = None
+        open(path, "wb").close()
+
+    def poll(self):
+        if self.__returncode is None:
+            now = min(self.__clock.time(), self.__exit_time)
+            try:
+                os.truncate(self.__path, int((now - self.__start) * self.__bitrate))
+            except FileNotFoundError:
+                pass
+            if self.__clock.time() >= self.__exit_time:
+                self.__returncode = 0
+        return self.__returncode
+
+    def terminate(self):
+        self.poll()
+        if self.__returncode is None:
+            self.__returncode = -15
+
+
+class FakeProcessFactory:
+    def __init__(self, sessions, clock, bitrate):
+        self.__sessions = sessions
+        self.__clock = clock
+        self.__bitrate = bitrate
+
+    def __call__(self, args, **kwargs):
+        path = args[args.index("-o") + 1]
+        channel = next(arg for arg in args if arg.startswith("twitch.tv/"))[10:]
+        now = self.__clock.time()
+        exit_time = now + FAILED_START_DELAY
+        for start, end in self.__sessions.get(channel, []):
+            if start <= now < end:
+                exit_time = end
+                break
+        return FakeProcess(path, self.__clock, exit_time, self.__bitrate)
+
+
+def parse_started_at(started_at):
+    return calendar.timegm(time.strptime(started_at, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def get_sessions(events):
+    """
+        What actually happened: when each channel was live, from the trace
+
+        A session starts at Twitch's `started_at` and ends when streamlink
+        exited on its own around the time the stream was last seen, or about
+        one poll after it was last seen if that never happened. Streams that
+        were already live when the trace began start at the first poll,
+        nothing before that could have been recorded.
+
+        Returns dict of channel to list of (start, end)
+    """
+    first_poll = _first_poll(events)
+    ids = dict()
+    last_seen = dict()
+    for event in events:
+        if event["e"] == "users":
+            ids.update({user_id: login for login, user_id in event["users"].items()})
+        elif event["e"] == "streams":
+            for stream in event["data"]:
+                key = (ids.get(stream["user_id"], stream["user_id"]), stream["started_at"])
+                last_seen[key] = event["t"]
+
+    exits = defaultdict(list)
+    for event in events:
+        if event["e"] == "process_exit":
+            exits[event["channel"]].append(event["t"])
+
+    sessions = defaultdict(list)
+    for (channel, started_at), seen in last_seen.items():
+        start = max(parse_started_at(started_at), first_poll)
+        end = seen + POLL_GRACE
+        for exit_time in exits[channel]:
+            if start < exit_time and seen - POLL_GRACE <= exit_time <= end:
+                end = exit_time
+                break
+        sessions[channel].append((start, end))
+    for channel in sessions:
+        sessions[channel].sort()
+    return dict(sessions)
+
+
+def get_decisions(events):
+    """
+        What the rules decided for each live channel at every poll
+
+        Returns dict of channel to list of (time, wanted), or None for traces
+        from before decisions were traced
+    """
+    decisions = None
+    for event in events:
+        if event["e"] == "decisions":
+            if decisions is None:
+                decisions = defaultdict(list)
+            for channel in event["record"]:
+                decisions[channel].append((event["t"], True))
+            for channel in event["skip"]:
+                decisions[channel].append((event["t"], False))
+    return decisions
+
+
+def get_bitrate(events):
+    # bytes per second seen by the file size checks in production
+    starts = dict()
+    rates = []
+    for event in events:
+        if event["e"] == "process_start":
+            starts[event["filename"]] = event["t"]
+        elif event["e"] == "file_size" and event["filename"] in starts:
+            elapsed = event["t"] - starts[event["filename"]]
+            if elapsed > 60:
+                rates.append(event["size"] / elapsed)
+    if not rates:
+        return DEFAULT_BITRATE
+    return sorted(rates)[len(rates) // 2]
+
+
+def _first_poll(events):
+    return min(
+        (event["t"] for event in events if event["e"] in ("streams", "error")),
+        default=0,
+    )
+
+
+def _wanted(decisions, start, end):
+    # the parts of a session the rules wanted recorded, each poll's decision
+    # holds until the next poll
+    if decisions is None:
+        return [(start, end)]
+    polls = [(t, wanted) for t, wanted in decisions if start <= t <= end]
+    if not polls:
+        return []
+    intervals = []
+    begin = start if polls[0][1] else None
+    for t, wanted in polls[1:]:
+        if wanted and begin is None:
+            begin = t
+        elif not wanted and begin is not None:
+            intervals.append((begin, t))
+            begin = None
+    if begin is not None:
+        intervals.append((begin, end))
+    return intervals
+
+
+def _active(sessions, channel, t):
+    for start, end in sessions.get(channel, []):
+        if start <= t < end:
+            return start, end
+    return None
+
+
+def analyze(events, sessions):
+    """
+        Compare what the recorder did in `events` with the real `sessions`
+
+        Only live time the rules wanted recorded counts, sessions they
+        skipped entirely are counted as filtered. Latencies are left out for
+        streams that were already live when the trace began.
+
+        Returns dict of channel to a report with detection and recording
+        latencies per session, false starts (recording a channel that wasn't
+        live), false stops (deciding a channel went offline while it was still
+        live) and the fraction of wanted live time that was recorded.
+    """
+    decisions = get_decisions(events)
+    first_poll = _first_poll(events)
+    recordings = defaultdict(list)
+    open_recordings = dict()
+    online = defaultdict(list)
+    false_starts = defaultdict(int)
+    false_stops = defaultdict(int)
+    end_of_trace = max((event["t"] for event in events), default=0)
+
+    for event in events:
+        if event["e"] == "process_start":
+            open_recordings[event["filename"]] = (event["channel"], event["t"])
+            if _active(sessions, event["channel"], event["t"]) is None:
+                false_starts[event["channel"]] += 1
+        elif event["e"] in ("process_exit", "process_stop"):
+            channel, start = open_recordings.pop(event["filename"], (event["channel"], None))
+            if start is not None:
+                recordings[channel].append((start, event["t"]))
+            session = _active(sessions, channel, event["t"])
+            if (
+                event["e"] == "process_stop"
+                and event.get("reason") == "offline"
+                and session is not None
+                and session[1] - event["t"] > POLL_GRACE
+            ):
+                false_stops[channel] += 1
+        elif event["e"] == "status":
+            for channel in event["went_online"]:
+                online[channel].append(event["t"])
+    for channel, start in open_recordings.values():
+        recordings[channel].append((start, end_of_trace))
+
+    report = dict()
+    for channel in sorted(set(sessions) | set(recordings)):
+        live_time = 0
+        recorded_time = 0
+        wanted_sessions = 0
+        filtered = 0
+        detection = []
+        recording_latency = []
+        for start, end in sessions.get(channel, []):
+            wanted = _wanted(
+                None if decisions is None else decisions.get(channel, []), start, end
+            )
+            if not wanted:
+                filtered += 1
+                continue
+            wanted_sessions += 1
+            for wanted_start, wanted_end in wanted:
+                live_time += wanted_end - wanted_start
+                recorded_time += sum(
+                    max(0, min(wanted_end, stop) - max(wanted_start, begin))
+                    for begin, stop in recordings[channel]
+                )
+            start = wanted[0][0]
+            if start <= first_poll:
+                # already live when the trace began
+                continue
+            detected = [t for t in online[channel] if start <= t < end]
+            detection.append(detected[0] - start if detected else None)
+            started = [begin for begin, stop in recordings[channel] if start <= begin < end]
+            recording_latency.append(started[0] - start if started else None)
+        report[channel] = {
+            "sessions": wanted_sessions,
+            "filtered": filtered,
+            "detection_latency": detection,
+            "recording_latency": recording_latency,
+            "false_starts": false_starts[channel],
+            "false_stops": false_stops[channel],
+            "coverage": recorded_time / live_time if live_time else None,
+        }
+    return report
+
+
+def print_report(report):
+    def seconds(values):
+        found = [value for value in values if value is not None]
+        if not found:
+            return "-"
+        missed = len(values) - len(found)
+        text = f"{sum(found) / len(found):.0f}s avg, {max(found):.0f}s max"
+        return text + (f", {missed} missed" if missed else "")
+
+    print(
+        f"{'channel':16} {'sessions':>8} {'filtered':>8}  {'detection':28} {'recording':28} "
+        f"{'starts':>6} {'stops':>6} {'coverage':>8}"
+    )
+    for channel, result in report.items():
+        coverage = result["coverage"]
+        print(
+            f"{channel:16} {result['sessions']:>8} {result['filtered']:>8}  "
+            f"{seconds(result['detection_latency']):28} "
+            f"{seconds(result['recording_latency']):28} "
+            f"{result['false_starts']:>6} {result['false_stops']:>6} "
+            f"{'-' if coverage is None else f'{coverage:.1%}':>8}"
+        )
+
+
+def replay(trace_path, config_path, speed=100, bitrate=None, verbose=False):
+    """
+        Run Record's decision logic against a recorded trace
+
+        The config is copied so the real one isn't touched and everything with
+        side effects outside of deciding what to record (chat, indexing,
+        tiering, Discord, tracing) is turned off. Recordings go to a temporary
+        directory as sparse files.
+    """
+    from record import Record
+
+    events = read_trace(trace_path)
+    times = [event["t"] for event in events if event["e"] in ("streams", "error")]
+    if not times:
+        raise ValueError(f"{trace_path} has no /helix/streams responses")
+    sessions = get_sessions(events)
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        for section in ["default", "discord", "chat", "tiering", "trace"]:
+            if not config.has_section(section):
+                config.add_section(section)
+        config["default"]["capture_directory"] = os.path.join(directory, "capture")
+        config["default"]["complete_directory"] = os.path.join(directory, "complete")
+        config["default"]["segment_index"] = "False"
+        config["discord"]["bot_enable"] = "False"
+        config["discord"]["webhook"] = ""
+        config["chat"]["enable"] = "False"
+        config["tiering"]["enable"] = "False"
+        config["trace"]["enable"] = "False"
+        os.mkdir(config["default"]["capture_directory"])
+        os.mkdir(config["default"]["complete_directory"])
+        replay_config_path = os.path.join(directory, "config.ini")
+        with open(replay_config_path, "w") as f:
+            config.write(f)
+
+        clock = SimulatedClock(times[0], times[-1], speed)
+        result = MemoryTrace()
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(None)
+        with output:
+            record = Record(
+                config_path=replay_config_path,
+                clock=clock,
+                helix=ReplayAPI(events, clock),
+                process_factory=FakeProcessFactory(
+                    sessions, clock, bitrate or get_bitrate(events)
+                ),
+                trace=result,
+            )
+            try:
+                record.start()
+            except ReplayFinished:
+                pass
+            record.cleanup()
+    return analyze(result.events, sessions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay recorded Helix poll sessions and report detection latency"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_parser = commands.add_parser(
+        "report", help="report on what production did in a trace"
+    )
+    report_parser.add_argument("trace")
+    replay_parser = commands.add_parser(
+        "replay", help="run the current decision logic against a trace"
+    )
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument(
+        "--config",
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"),
+    )
+    replay_parser.add_argument("--speed", type=float, default=100, help="0 for no waiting")
+    replay_parser.add_argument("--bitrate", type=float, help="bytes per second")
+    replay_parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        events = read_trace(args.trace)
+        report = analyze(events, get_sessions(events))
+    else:
+        report = replay(args.trace, args.config, args.speed, args.bitrate, args.verbose)
+    print_report(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
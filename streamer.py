@@ -2,26 +2,41 @@ import time
 import subprocess
 import os
 import logging
+import segment_index
 
 logger = logging.getLogger(__name__)
 
 
 class Streamer:
-    def __init__(self, name: str, capture_path: str, id: int, complete_path: str):
+    def __init__(
+        self,
+        name: str,
+        capture_path: str,
+        id: int,
+        complete_path: str,
+        index_segments: bool = False,
+        clock=time,
+        process_factory=subprocess.Popen,
+    ):
         self.__name = name
         self.__capture_path = capture_path
         self.__complete_path = complete_path
         self.__id = id
+        self.__index_segments = index_segments
+        # the time module and Popen unless a replay swaps them out
+        self.__clock = clock
+        self.__process_factory = process_factory
         self.__live = False
+        self.__game_id = None
         self.__recording = False
         self.__process = None
         self.__filename = None
         logger.debug(f"Created Streamer object for {name}")
 
     def start_recording(self):
-        file_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+        file_time = self.__clock.strftime("%Y-%m-%d_%H-%M-%S")
         self.__filename = f"twitch_{self.__name}_{file_time}.ts"
-        self.__process = subprocess.Popen(
+        self.__process = self.__process_factory(
             [
                 "streamlink",
                 "-o",
@@ -47,12 +62,16 @@ class Streamer:
         self.__process.terminate()
         self.__process = None
         self.__recording = False
-        time.sleep(2)
+        self.__clock.sleep(2)
         try:
             os.rename(
                 os.path.join(self.__capture_path, self.__filename),
                 os.path.join(self.__complete_path, self.__filename),
             )
+            if self.__index_segments:
+                segment_index.build_in_background(
+                    os.path.join(self.__complete_path, self.__filename)
+                )
         except FileNotFoundError:
             logger.error(f"{self.__filename} not found. probably deleted by user")
             pass
@@ -62,7 +81,7 @@ class Streamer:
         self.__filename = None
 
     def __get_current_time(self) -> str:
-        return time.strftime("%H:%M:%S")
+        return self.__clock.strftime("%H:%M:%S")
 
     def check_recording_process(self):
         """
@@ -81,6 +100,12 @@ class Streamer:
     def get_live_status(self):
         return self.__live
 
+    def set_game_id(self, game_id):
+        self.__game_id = game_id
+
+    def get_game_id(self):
+        return self.__game_id
+
     def get_recording_status(self):
         return self.__recording
 
@@ -0,0 +1,528 @@
+import configparser
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+HOT = "hot"
+COLD = "cold"
+
+CHUNK_SIZE = 1024 * 1024
+GIGABYTE = 1024 * 1024 * 1024
+DAY = 24 * 60 * 60
+
+POLICY_KEYS = [
+    "hot_max_age_days",
+    "hot_max_size_gb",
+    "cold_max_age_days",
+    "cold_max_size_gb",
+]
+
+# the recording, its segment index and its chat log
+RECORDING_EXTENSIONS = [".ts", ".ts.idx", ".log.gz"]
+
+
+def get_stem(filename):
+    # twitch_<name>_<time>.ts, .ts.idx and .log.gz all belong to one recording
+    return filename.split(".", 1)[0]
+
+
+def get_channel(filename):
+    parts = get_stem(filename).split("_")
+    if len(parts) < 4 or parts[0] != "twitch":
+        return None
+    try:
+        time.strptime("_".join(parts[-2:]), "%Y-%m-%d_%H-%M-%S")
+    except ValueError:
+        return None
+    return "_".join(parts[1:-2])
+
+
+def is_recording(filename):
+    """
+        Whether a file is part of a recording. Nothing else is ever moved or deleted
+    """
+    return (
+        filename[len(get_stem(filename)) :] in RECORDING_EXTENSIONS
+        and get_channel(filename) is not None
+    )
+
+
+class _CopyStopped(Exception):
+    pass
+
+
+class Throttle:
+    """
+        Limits how fast all copy workers together can read from the hot volume
+    """
+
+    def __init__(self, bytes_per_second):
+        self.__bytes_per_second = bytes_per_second
+        self.__next = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.__bytes_per_second:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            start = max(self.__next, now)
+            self.__next = start + size / self.__bytes_per_second
+            wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class FileIndex:
+    """
+        Persistent index of the files in the hot and cold directories
+
+        A directory is only listed again when its mtime changes, which only
+        happens when files are added, removed or renamed. Files we move
+        ourselves are updated in place so the cold directory, which is the
+        one that grows large, is practically never re-listed.
+    """
+
+    def __init__(self, path):
+        self.__db = sqlite3.connect(path)
+        self.__db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                tier TEXT NOT NULL,
+                stem TEXT NOT NULL,
+                channel TEXT,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                checksum TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_tier_stem ON files (tier, stem);
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
+            );
+            """
+        )
+
+    def close(self):
+        self.__db.close()
+
+    def scan(self, directory, tier):
+        """
+            Bring the index up to date with `directory` if it has changed
+        """
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            logger.error(f"{directory} not found")
+            return False
+        row = self.__db.execute(
+            "SELECT mtime_ns FROM directories WHERE path = ?", (directory,)
+        ).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return False
+
+        indexed = {
+            path: (size, mtime)
+            for path, size, mtime in self.__db.execute(
+                "SELECT path, size, mtime FROM files WHERE tier = ?", (tier,)
+            )
+        }
+        with self.__db:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not is_recording(entry.name):
+                        continue
+                    stat = entry.stat()
+                    known = indexed.pop(entry.path, None)
+                    if known == (stat.st_size, stat.st_mtime):
+                        continue
+                    self.__db.execute(
+                        "REPLACE INTO files (path, tier, stem, channel, size, mtime) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (
+                            entry.path,
+                            tier,
+                            get_stem(entry.name),
+                            get_channel(entry.name),
+                            stat.st_size,
+                            stat.st_mtime,
+                        ),
+                    )
+            self.__db.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in indexed]
+            )
+            self.__set_directory_mtime(directory, mtime_ns)
+        logger.debug(f"rescanned {directory}")
+        return True
+
+    def __set_directory_mtime(self, directory, mtime_ns):
+        self.__db.execute(
+            "REPLACE INTO directories (path, mtime_ns) VALUES (?, ?)",
+            (directory, mtime_ns),
+        )
+
+    def mark_directory_current(self, directory):
+        # after our own changes the index already matches the directory
+        with self.__db:
+            self.__set_directory_mtime(directory, os.stat(directory).st_mtime_ns)
+
+    def groups(self, tier):
+        """
+            Recordings in `tier`, oldest first
+
+            Returns a list of (stem, channel, size, mtime, paths)
+        """
+        groups = dict()
+        for path, stem, channel, size, mtime in self.__db.execute(
+            "SELECT path, stem, channel, size, mtime FROM files WHERE tier = ?",
+            (tier,),
+        ):
+            if not is_recording(os.path.basename(path)):
+                # indexed by an older version that didn't skip other files
+                continue
+            group = groups.setdefault(stem, [stem, channel, 0, 0, []])
+            group[2] += size
+            group[3] = max(group[3], mtime)
+            group[4].append(path)
+        return sorted((tuple(group) for group in groups.values()), key=lambda g: g[3])
+
+    def moved(self, old_path, new_path, tier, checksum):
+        with self.__db:
+            self.__db.execute(
+                "UPDATE files SET path = ?, tier = ?, checksum = ? WHERE path = ?",
+                (new_path, tier, checksum, old_path),
+            )
+
+    def updated(self, path, size, mtime):
+        with self.__db:
+            self.__db.execute(
+                "UPDATE files SET size = ?, mtime = ? WHERE path = ?",
+                (size, mtime, path),
+            )
+
+    def removed(self, path):
+        with self.__db:
+            self.__db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+
+class TieringService:
+    """
+        Moves completed recordings from the hot to the cold directory and
+        prunes the cold directory by age and size
+
+        Policies are in days and gigabytes, 0 disables a limit. Ages in
+        `channels` replace the default for that channel, sizes in `channels`
+        limit that channel's total on top of the default. Only recordings are
+        touched, and a recording (the .ts and its chat log and index) always
+        moves or gets deleted as a whole.
+
+        Parameters
+        ----------
+        hot_path : str
+            complete_directory
+        cold_path : str
+            archive directory, usually on another volume
+        index_path : str
+            sqlite file the file index is kept in
+        policy : dict
+            default limits, keys from POLICY_KEYS
+        channels : dict
+            channel name to dict of limits overriding `policy`
+        workers : int
+            number of files copied in parallel
+        bandwidth : float
+            MB/s all copies together may read from the hot directory, 0 for no limit
+        interval : float
+            seconds between passes
+        settle_time : float
+            files modified more recently than this are left alone
+    """
+
+    def __init__(
+        self,
+        hot_path,
+        cold_path,
+        index_path,
+        policy,
+        channels=None,
+        workers=2,
+        bandwidth=50,
+        interval=600,
+        settle_time=600,
+    ):
+        self.__hot_path = hot_path
+        self.__cold_path = cold_path
+        self.__index_path = index_path
+        self.__policy = {key: policy.get(key, 0) for key in POLICY_KEYS}
+        self.__channels = channels or dict()
+        self.__workers = workers
+        self.__throttle = Throttle(bandwidth * 1024 * 1024)
+        self.__interval = interval
+        self.__settle_time = settle_time
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        # copies in progress are abandoned and their partial files removed
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        index = FileIndex(self.__index_path)
+        try:
+            while not self.__stop.is_set():
+                try:
+                    self.run_once(index)
+                except Exception:
+                    logger.error("error while tiering recordings", exc_info=True)
+                self.__stop.wait(self.__interval)
+        finally:
+            index.close()
+
+    def run_once(self, index):
+        index.scan(self.__hot_path, HOT)
+        index.scan(self.__cold_path, COLD)
+
+        to_move = self.__select(
+            index, index.groups(HOT), "hot_max_age_days", "hot_max_size_gb"
+        )
+        if to_move:
+            self.__move(index, to_move)
+            # only the cold directory is skipped next time. new recordings can
+            # land in the hot directory while copying and it's small to list
+            index.mark_directory_current(self.__cold_path)
+
+        to_delete = self.__select(
+            index, index.groups(COLD), "cold_max_age_days", "cold_max_size_gb"
+        )
+        if to_delete:
+            for stem, channel, size, mtime, paths in to_delete:
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    index.removed(path)
+                logger.info(f"deleted {stem} from {self.__cold_path}")
+            index.mark_directory_current(self.__cold_path)
+
+    def __get_limit(self, channel, key):
+        return self.__channels.get(channel, dict()).get(key, self.__policy[key])
+
+    def __select(self, index, groups, age_key, size_key):
+        # groups are oldest first so size limits drop the oldest recordings
+        now = time.time()
+        total = 0
+        channel_totals = defaultdict(int)
+        for stem, channel, size, mtime, paths in groups:
+            total += size
+            channel_totals[channel] += size
+
+        def wanted(channel, mtime):
+            if now - mtime < self.__settle_time:
+                return False
+            max_age = self.__get_limit(channel, age_key)
+            max_size = self.__policy[size_key]
+            channel_max_size = self.__channels.get(channel, dict()).get(size_key, 0)
+            return (
+                (max_age and now - mtime > max_age * DAY)
+                or (max_size and total > max_size * GIGABYTE)
+                or (channel_max_size and channel_totals[channel] > channel_max_size * GIGABYTE)
+            )
+
+        selected = []
+        for group in groups:
+            stem, channel, size, mtime, paths = group
+            if not wanted(channel, mtime):
+                continue
+            # the index goes stale for files that are still growing, e.g. when
+            # capture_directory and complete_directory are the same
+            group = self.__refresh(index, group)
+            if group is None or not wanted(channel, group[3]):
+                continue
+            selected.append(group)
+            total -= size
+            channel_totals[channel] -= size
+        return selected
+
+    def __refresh(self, index, group):
+        stem, channel, size, mtime, paths = group
+        size = 0
+        mtime = 0
+        found = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                index.removed(path)
+                continue
+            index.updated(path, stat.st_size, stat.st_mtime)
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+            found.append(path)
+        if not found:
+            return None
+        return stem, channel, size, mtime, found
+
+    def __move(self, index, groups):
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            futures = [
+                (group, executor.submit(self.__move_group, group[4]))
+                for group in groups
+            ]
+            for (stem, channel, size, mtime, paths), future in futures:
+                try:
+                    moved = future.result()
+                except _CopyStopped:
+                    continue
+                except (OSError, ValueError):
+                    logger.error(
+                        f"failed to move {stem}, leaving it in {self.__hot_path}",
+                        exc_info=True,
+                    )
+                    continue
+                for path, new_path, checksum in moved:
+                    index.moved(path, new_path, COLD, checksum)
+
+    def __move_group(self, paths):
+        """
+            Move every file of a recording or none of them
+        """
+        if self.__stop.is_set():
+            raise _CopyStopped()
+        now = time.time()
+        for path in paths:
+            if now - os.stat(path).st_mtime < self.__settle_time:
+                logger.info(f"{path} is still being written. not moving it")
+                return []
+        destinations = [
+            os.path.join(self.__cold_path, os.path.basename(path)) for path in paths
+        ]
+
+        if os.stat(paths[0]).st_dev == os.stat(self.__cold_path).st_dev:
+            done = []
+            try:
+                for path, destination in zip(paths, destinations):
+                    os.replace(path, destination)
+                    done.append((path, destination))
+            except OSError:
+                for path, destination in reversed(done):
+                    os.replace(destination, path)
+                raise
+            logger.info(f"moved {paths} to {self.__cold_path}")
+            return [(path, destination, None) for path, destination in done]
+
+        parts = [f"{destination}.part" for destination in destinations]
+        placed = []
+        try:
+            checksums = [
+                self.__copy_file(path, part) for path, part in zip(paths, parts)
+            ]
+            for path, part, destination in zip(paths, parts, destinations):
+                os.replace(part, destination)
+                placed.append(destination)
+                # keep the original mtime so age policies still apply in the cold directory
+                shutil.copystat(path, destination)
+        except BaseException:
+            # the originals haven't been touched yet, drop everything copied so far
+            for leftover in parts + placed:
+                try:
+                    os.remove(leftover)
+                except FileNotFoundError:
+                    pass
+            raise
+
+        for path in paths:
+            os.remove(path)
+        for path, destination, checksum in zip(paths, destinations, checksums):
+            logger.info(f"moved {path} to {destination} ({checksum})")
+        return list(zip(paths, destinations, checksums))
+
+    def __copy_file(self, path, part):
+        """
+            Copy `path` to `part` and return the sha256 of the data
+
+            The copy is read back and compared after the cached pages are
+            dropped, so the check covers what's on the cold disk. Where
+            posix_fadvise isn't available (e.g. Windows) the read back may
+            come from the page cache and only covers the copy itself.
+        """
+        source_hash = hashlib.sha256()
+        with open(path, "rb") as source, open(part, "wb") as target:
+            while True:
+                if self.__stop.is_set():
+                    raise _CopyStopped()
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.__throttle.consume(len(chunk))
+                source_hash.update(chunk)
+                target.write(chunk)
+            target.flush()
+            os.fsync(target.fileno())
+
+        target_hash = hashlib.sha256()
+        with open(part, "rb") as target:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(target.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            for chunk in iter(lambda: target.read(CHUNK_SIZE), b""):
+                target_hash.update(chunk)
+        checksum = source_hash.hexdigest()
+        if target_hash.hexdigest() != checksum:
+            raise ValueError(f"checksum mismatch copying {path} to {part}")
+        return checksum
+
+
+def from_config(config, hot_path, index_path):
+    """
+        Build a TieringService from the [tiering] section, or None if it's disabled
+    """
+    if not config.getboolean("tiering", "enable", fallback=False):
+        return None
+    return TieringService(
+        hot_path,
+        os.path.normpath(config["tiering"]["cold_directory"]),
+        index_path,
+        {key: config.getfloat("tiering", key, fallback=0) for key in POLICY_KEYS},
+        channels=json.loads(config.get("tiering", "channels", fallback="{}")),
+        workers=config.getint("tiering", "workers", fallback=2),
+        bandwidth=config.getfloat("tiering", "bandwidth", fallback=50),
+        interval=config.getfloat("tiering", "interval", fallback=600),
+    )
+
+
+if __name__ == "__main__":
+    # run a single pass, e.g. from cron instead of inside record.py
+    current_directory = os.path.dirname(os.path.realpath(__file__))
+    config = configparser.ConfigParser()
+    config.read(os.path.join(current_directory, "config.ini"))
+    logging.basicConfig(level=logging.INFO)
+    service = from_config(
+        config,
+        os.path.normpath(config["default"]["complete_directory"]),
+        os.path.join(current_directory, "tiering.db"),
+    )
+    if service is None:
+        print("tiering is disabled in config.ini")
+        sys.exit(1)
+    index = FileIndex(os.path.join(current_directory, "tiering.db"))
+    service.run_once(index)
+    index.close()